@@ -208,14 +208,17 @@ class InstructionCompiler:
             "action_output": action_output,
         }
 
-    def step(self):
-        """Run the compiler."""
+    def step(self, action_info=None):
+        """Run the compiler. If the action output for the next instruction was
+        already fetched, e.g., ahead of time, pass it in as `action_info` to
+        skip the call to the language model."""
         # For each instruction, give the base prompt the current instruction.
         # Then, get the completion for that instruction.
         instructions = self.instructions_queue.pop(0)
         if instructions.strip():
             instructions = instructions.strip()
-            action_info = self.get_action_output(instructions)
+            if action_info is None:
+                action_info = self.get_action_output(instructions)
             self.history.append(action_info)
 
             # Optimistically count the instruction as finished.
@@ -1,26 +1,38 @@
 """GPT Selenium Agent abstraction."""
+import ast
+import collections
+import dbm
+import hashlib
+import json
+import os
 import pdb
-import re
+import shelve
 import sys
 import time
 import openai
 import traceback
-import html2text
 import nltk
-from nltk.tokenize import sent_tokenize
-from bs4 import BeautifulSoup
-from bs4.element import NavigableString
-from bs4.element import Tag
+from concurrent.futures import ThreadPoolExecutor
+from lxml import html as lxml_html
 from llama_index import Document, GPTSimpleVectorIndex
+from llama_index.embeddings.openai import get_embeddings
+from llama_index.langchain_helpers.text_splitter import TokenTextSplitter
 from selenium import webdriver
+from selenium.common.exceptions import NoSuchElementException
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.common.action_chains import ActionChains
+from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.relative_locator import locate_with
+from selenium.webdriver.support.ui import WebDriverWait
 from .compilers.instruction_compiler import InstructionCompiler
 
-nltk.download("punkt")
+# Only download the sentence tokenizer if it isn't installed yet.
+try:
+    nltk.data.find("tokenizers/punkt")
+except LookupError:
+    nltk.download("punkt", quiet=True)
 
 import logging
 logging.basicConfig(level=logging.INFO)
@@ -28,8 +40,120 @@ logger = logging.getLogger(__name__)
 
 NO_RESPONSE_TOKEN = "<NONE>"  # To denote that empty response from model.
 
+# Rate-limited completions are retried with exponential backoff: 1, 2, 4, ...
+# seconds, up to this many times.
+MAX_RATE_LIMIT_RETRIES = 5
+
+# Embeddings are requested in batches; the API accepts up to 2048 inputs. Texts
+# are first split into chunks of at most EMBEDDING_CHUNK_SIZE tokens, well
+# under the model's 8191 token input limit.
+EMBEDDING_MODEL = "text-embedding-ada-002"
+EMBEDDING_BATCH_SIZE = 2048
+EMBEDDING_CHUNK_SIZE = 2048
+
+# LLM responses and vector indexes are cached on disk so that repeated prompts
+# are free, even across runs. Only the most recently used ones are kept.
+LLM_CACHE_FILENAME = "llm_responses"
+MAX_CACHED_LLM_RESPONSES = 1000
+MAX_CACHED_INDEXES = 32
+
+# Counts DOM mutations on the current page, so that we can tell whether the
+# DOM changed without serializing it. Installed at most once per document.
+INSTALL_MUTATION_COUNTER_JS = """
+if (window.__bp_mut_counter === undefined) {
+  window.__bp_mut_counter = 0;
+  new MutationObserver(() => { window.__bp_mut_counter++; })
+    .observe(document, {childList: true, subtree: true, attributes: true});
+}
+"""
+
+# Cheap fingerprint of the current page. The time origin tells documents with
+# the same URL apart, e.g., after a reload.
+DOM_FINGERPRINT_JS = INSTALL_MUTATION_COUNTER_JS + """
+return document.URL + '|' + performance.timeOrigin + '|' + window.__bp_mut_counter;
+"""
+
+# Paragraph text of the current document.
+PARAGRAPHS_JS = "return Array.from(document.querySelectorAll('p'), p => p.innerText).join('\\n');"
+
+# Collects the paragraph text of every same-origin iframe in one round-trip,
+# rather than switching into each frame and shipping its page source back.
+# Cross-origin frames can't be read from the parent, so their text is null.
+IFRAME_PARAGRAPHS_JS = """
+const out = [];
+for (const f of document.querySelectorAll('iframe')) {
+  try {
+    const ps = f.contentDocument.querySelectorAll('p');
+    out.push(Array.from(ps, p => p.innerText).join('\\n'));
+  } catch (e) {
+    out.push(null);
+  }
+}
+return out;
+"""
+
+# Elements stripped, along with their children, from the HTML before it is
+# shown to the LLM.
+BLACKLISTED_ELEMENTS = frozenset(
+    ["head", "title", "meta", "script", "style", "path", "svg", "br"]
+)
+
+# Attributes stripped from the HTML before it is shown to the LLM. Names are
+# either matched exactly or by prefix, e.g., "aria-label" or "data-id".
+BLACKLISTED_ATTRIBUTES = frozenset(["style", "ping", "src"])
+BLACKLISTED_ATTRIBUTE_PREFIXES = ("item", "aria", "js", "data-")
+
+# Serializes every element that survives the blacklists as a childless tag
+# with its remaining attributes in sorted order, e.g., `<a href="/login"/>`.
+# Runs entirely in the browser so that only the distilled candidates come back
+# over the wire.
+CANDIDATE_ELEMENTS_JS = """
+const [badTags, badAttrs, badPrefixes] = arguments;
+const badSelector = badTags.join(',');
+const out = [];
+for (const el of document.querySelectorAll('*')) {
+  if (el.closest(badSelector)) continue;
+  const attrs = Array.from(el.attributes)
+    .sort((a, b) => (a.name < b.name ? -1 : 1))
+    .filter(a => !badAttrs.includes(a.name) && !badPrefixes.some(p => a.name.startsWith(p)))
+    .map(a => `${a.name}="${a.value.replace(/"/g, '&quot;')}"`);
+  if (attrs.length) out.push(`<${el.localName} ${attrs.join(' ')}/>`);
+}
+return out;
+"""
+
+# Upper bound on the candidate elements embedded by ask_llm_to_find_element.
+MAX_CANDIDATE_ELEMENTS = 500
+
+# Modules that generated code is never allowed to reference.
+BLACKLISTED_MODULES = frozenset(
+    ["shutil", "requests", "urllib", "os", "sys", "subprocess"]
+)
+
+# Builtins that would let generated code run or import arbitrary code out of
+# sight of the AST check, e.g., `exec("import os")`, or reach the namespace
+# that holds the builtins, e.g., `globals()["__builtins__"]`.
+BLACKLISTED_NAMES = frozenset(
+    [
+        "__import__",
+        "__builtins__",
+        "exec",
+        "eval",
+        "compile",
+        "getattr",
+        "setattr",
+        "delattr",
+        "globals",
+        "locals",
+        "vars",
+    ]
+)
+
 
 class GPTSeleniumAgent:
+    # Shared by both ways of running instructions to shut down the browser.
+    _QUIT_CODE = compile("env.driver.quit()", "<quit>", "exec")
+
     def __init__(
         self,
         instructions,
@@ -38,14 +162,18 @@ class GPTSeleniumAgent:
         headless=False,
         debug=False,
         instruction_output_file=None,
+        cache_dir=".bp_cache",
     ):
-        """Initialize the agent."""
+        """Initialize the agent. LLM responses and vector indexes are cached
+        in `cache_dir`, which is created on first write; pass None to keep
+        them in memory only."""
         # Helpful instance variables.
         assert instruction_output_file is None or instruction_output_file.endswith(
             ".yaml"
         ), "Instruction output file must be a YAML file or None."
         self.instruction_output_file = instruction_output_file
         self.debug = debug
+        self.cache_dir = cache_dir
 
         # Set up the driver.
         chrome_options = webdriver.ChromeOptions()
@@ -58,6 +186,30 @@ class GPTSeleniumAgent:
         service = Service(chromedriver_path)
         self.driver = webdriver.Chrome(service=service, options=chrome_options)
 
+        # Cache of the candidate elements, keyed on a fingerprint of the page.
+        self._dom_cache = {}
+
+        # Compiled code objects for each action string that has been run, and
+        # the namespace they run in. The same dict serves as both globals and
+        # locals, so variables carry over from one action to the next.
+        self._code_cache = {}
+        self._action_ns = {
+            "By": By,
+            "Keys": Keys,
+            "ActionChains": ActionChains,
+            "WebDriverWait": WebDriverWait,
+            "env": self,
+        }
+
+        # Cache of LLM responses, keyed on (model, temperature, prompt) and
+        # loaded from disk.
+        self._llm_cache = {}
+        self._load_llm_cache()
+
+        # Sentence tokenizer, loaded on first use by retrieve_information and
+        # then reused.
+        self._sentence_tokenizer = None
+
         # Fire up the compiler.
         self.instruction_compiler = InstructionCompiler(instructions=instructions)
 
@@ -70,74 +222,188 @@ class GPTSeleniumAgent:
             logging.warning("Action: {action}".format(action=action_str))
             sys.exit(1)
 
-    def _is_potentially_dangerous(self, code_str):
+    @staticmethod
+    def _is_potentially_dangerous(code_str):
         """Isaac Asimov is rolling over in his grave."""
-        # Check that the code doesn't try any funny business with the importing.
-        if "import " in code_str:
-            return True
-
-        # Check that the code doesn't use any of the following libraries.
-        blacklisted_libraries = ["shutil", "requests", "urllib"]  # "os", "sys".
-        for library in blacklisted_libraries:
-            if library in code_str:
+        # Code that doesn't parse can't be executed either; let the retry
+        # loop deal with the SyntaxError.
+        try:
+            tree = ast.parse(code_str)
+        except SyntaxError:
+            return False
+
+        for node in ast.walk(tree):
+            # Check that the code doesn't try any funny business with the
+            # importing.
+            if isinstance(node, (ast.Import, ast.ImportFrom)):
                 return True
 
-        # # Check that the code doesn't use any of the following functions.
-        # blacklisted_functions = ["open", "exec", "eval", "input", "print", "write"]
-        # for function in blacklisted_functions:
-        #     if function in code_str:
-        #         return True
+            # Check that the code doesn't use any of the blacklisted modules,
+            # or sneak code in through `__import__`, `exec`, and friends.
+            if isinstance(node, ast.Name) and (
+                node.id in BLACKLISTED_MODULES or node.id in BLACKLISTED_NAMES
+            ):
+                return True
+
+            # Check that the code doesn't reach into private or dunder
+            # attributes, e.g., `env._action_ns` or `__globals__`, to climb
+            # back to the builtins.
+            if isinstance(node, ast.Attribute) and node.attr.startswith("_"):
+                return True
+
+            # Dunder names can also be looked up by string, e.g.,
+            # `namespace["__builtins__"]`.
+            if (
+                isinstance(node, ast.Constant)
+                and isinstance(node.value, str)
+                and node.value.startswith("__")
+                and node.value.endswith("__")
+            ):
+                return True
 
         return False
 
-    def _clean_html(self):
-        """Clean HTML to remove blacklisted elements and attributes."""
-        blacklisted_elements = set(
-            [
-                "head",
-                "title",
-                "meta",
-                "script",
-                "style",
-                "path",
-                "svg",
-                "br",
-                "::marker",
-            ]
+    def _compile_action(self, action):
+        """Compile the action string once and reuse the code object."""
+        code = self._code_cache.get(action)
+        if code is None:
+            code = compile(action, "<action>", "exec")
+            self._code_cache[action] = code
+        return code
+
+    def _get_embeddings(self, texts):
+        """Embed a list of strings, one API request per batch of texts. Goes
+        through GPT Index's helper, which normalizes newlines the same way as
+        for queries and retries rate limits."""
+        embeddings = []
+        for i in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+            batch = texts[i : i + EMBEDDING_BATCH_SIZE]
+            embeddings.extend(get_embeddings(batch, engine=EMBEDDING_MODEL))
+        return embeddings
+
+    def _build_index(self, texts, persist=False):
+        """Build a vector index over the texts from precomputed embeddings,
+        so that GPT Index does not embed each document on its own. With
+        `persist`, indexes are saved to disk, keyed on the texts, and reused
+        when the same content is indexed again."""
+        path = None
+        if persist and self.cache_dir is not None:
+            content_hash = hashlib.sha1("\0".join(texts).encode()).hexdigest()[:16]
+            filename = "idx_{hash}.json".format(hash=content_hash)
+            path = os.path.join(self.cache_dir, filename)
+            if os.path.exists(path):
+                os.utime(path)  # Mark as recently used.
+                return GPTSimpleVectorIndex.load_from_disk(path)
+
+        # Split the texts the same way the index will, so that each document
+        # is a single node and its precomputed embedding applies to it.
+        text_splitter = TokenTextSplitter(chunk_size=EMBEDDING_CHUNK_SIZE)
+        chunks = [chunk for text in texts for chunk in text_splitter.split_text(text)]
+        embeddings = self._get_embeddings(chunks)
+        docs = [
+            Document(chunk, embedding=embedding)
+            for chunk, embedding in zip(chunks, embeddings)
+        ]
+        index = GPTSimpleVectorIndex(docs, text_splitter=text_splitter)
+        if path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            index.save_to_disk(path)
+            self._evict_cached_indexes()
+        return index
+
+    def _evict_cached_indexes(self):
+        """Delete the least recently used indexes on disk beyond
+        MAX_CACHED_INDEXES."""
+        paths = [
+            os.path.join(self.cache_dir, filename)
+            for filename in os.listdir(self.cache_dir)
+            if filename.startswith("idx_") and filename.endswith(".json")
+        ]
+        paths.sort(key=os.path.getmtime, reverse=True)
+        for path in paths[MAX_CACHED_INDEXES:]:
+            os.remove(path)
+
+    def _load_llm_cache(self):
+        """Load the LLM responses cached by previous runs, if any."""
+        if self.cache_dir is None:
+            return
+        path = os.path.join(self.cache_dir, LLM_CACHE_FILENAME)
+        if not dbm.whichdb(path):
+            return
+        with shelve.open(path, flag="r") as db:
+            for key, entry in db.items():
+                model, temperature, prompt = json.loads(key)
+                self._llm_cache[(model, temperature, prompt)] = entry["response"]
+
+    def _cache_llm_response(self, key, response):
+        """Cache the response in memory and, if enabled, on disk. Only the
+        MAX_CACHED_LLM_RESPONSES most recently written responses are kept on
+        disk."""
+        self._llm_cache[key] = response
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = os.path.join(self.cache_dir, LLM_CACHE_FILENAME)
+        with shelve.open(path) as db:
+            db[json.dumps(key)] = {"response": response, "time": time.time()}
+            excess = len(db) - MAX_CACHED_LLM_RESPONSES
+            if excess > 0:
+                oldest = sorted(db.keys(), key=lambda k: db[k]["time"])[:excess]
+                for k in oldest:
+                    del db[k]
+
+    def _get_dom_cache(self):
+        """Return the cache for the current state of the page, starting a
+        fresh one if the page changed since it was last filled."""
+        fingerprint = self.driver.execute_script(DOM_FINGERPRINT_JS)
+        if self._dom_cache.get("fingerprint") != fingerprint:
+            self._dom_cache = {"fingerprint": fingerprint}
+        return self._dom_cache
+
+    def _get_candidate_elements(self):
+        """Get the cleaned elements of the page, without their children, as
+        HTML strings. Cached until the page changes."""
+        cache = self._get_dom_cache()
+        if "elements" not in cache:
+            cache["elements"] = self.driver.execute_script(
+                CANDIDATE_ELEMENTS_JS,
+                sorted(BLACKLISTED_ELEMENTS),
+                sorted(BLACKLISTED_ATTRIBUTES),
+                list(BLACKLISTED_ATTRIBUTE_PREFIXES),
+            )
+        return cache["elements"]
+
+    @staticmethod
+    def _select_candidate_elements(elements):
+        """Dedupe the candidate elements and, if there are more than
+        MAX_CANDIDATE_ELEMENTS, keep the most distinctive ones: rarer tags
+        first, then more attributes. Kept elements stay in page order."""
+        # Repeated structures, e.g., list items or table cells, serialize to
+        # the same tag and attributes; embed each signature only once.
+        elements = list(dict.fromkeys(elements))
+        if len(elements) <= MAX_CANDIDATE_ELEMENTS:
+            return elements
+
+        # Elements look like `<a href="/login"/>`, with any quotes in values
+        # escaped, so each `="` starts an attribute value.
+        tags = [element[1:].split(" ", 1)[0] for element in elements]
+        tag_counts = collections.Counter(tags)
+        ranked = sorted(
+            range(len(elements)),
+            key=lambda i: (tag_counts[tags[i]], -elements[i].count('="')),
         )
-        blacklisted_attributes = set(
-            ["style", "ping", "src", "item*", "aria*", "js*", "data-*"]
+        logging.info(
+            "Found {num} candidate elements. Keeping the {max} most distinctive.".format(
+                num=len(elements), max=MAX_CANDIDATE_ELEMENTS
+            )
         )
-
-        # Get the HTML tag for the entire page, convert into BeautifulSoup.
-        html = self.driver.find_element(By.TAG_NAME, "html")
-        html_string = html.get_attribute("outerHTML")
-        soup = BeautifulSoup(html_string, "lxml")
-
-        # Remove blacklisted items and attributes in it.
-        for blacklisted in blacklisted_elements:
-            for tag in soup.find_all(blacklisted):
-                tag.decompose()
-
-        # Set up a helper function to delete the blacklisted attributes from
-        # a tag, as long as the attribute name matches the regex.
-        def remove_blacklisted_attributes(tag, blacklisted_attributes):
-            for attr in tag.attrs.copy():
-                for pattern in blacklisted_attributes:
-                    if re.match(pattern, attr):
-                        del tag[attr]
-
-        for tag in soup.find_all(True):
-            remove_blacklisted_attributes(tag, blacklisted_attributes)
-
-        return soup
+        return [elements[i] for i in sorted(ranked[:MAX_CANDIDATE_ELEMENTS])]
 
     def __run_compiled_instructions(self, instructions):
         """Runs Python code previously compiled by InstructionCompiler."""
-        ldict = {"env": self}
         self._check_danger(instructions)
-        exec(instructions, globals(), ldict)
-        exec("env.driver.quit()", globals(), ldict)
+        exec(self._compile_action(instructions), self._action_ns)
+        exec(self._QUIT_CODE, self._action_ns)
 
     def __print_instruction_and_action(self, instruction, action):
         """Logging the instruction and action."""
@@ -147,65 +413,93 @@ class GPTSeleniumAgent:
 
     def __get_relevant_part_of_stack_trace(self):
         """Get the relevant part of the stack trace."""
-        stack_trace = traceback.format_exc()
-        stack_trace = stack_trace.split("\n")[3:5]
-        stack_trace = "\n".join(stack_trace)
+        exc_type, exc, tb = sys.exc_info()
+        # A SyntaxError is raised while compiling, so it has no frame in the
+        # action; it carries the line number itself.
+        line_num = 1
+        if isinstance(exc, SyntaxError) and exc.lineno:
+            line_num = exc.lineno
+        # Walk the traceback down to the frame of the action itself.
+        while tb is not None and tb.tb_frame.f_code.co_filename != "<action>":
+            tb = tb.tb_next
+        if tb is not None:
+            line_num = tb.tb_lineno
+
+        stack_trace = traceback.format_tb(tb, limit=2)
+        stack_trace += traceback.format_exception_only(exc_type, exc)
+        stack_trace = "".join(stack_trace)
         # Get the name of this class (GPTSeleniumAgent) and
         # replace it with "env".
         class_name = self.__class__.__name__
         stack_trace = stack_trace.replace(class_name, "env")
-        # Get the number after the word "line " in the stack trace.
-        line_num = int(stack_trace.split("line ")[1].split(",")[0])
         return {"stack_trace": stack_trace, "line_num": line_num}
 
+    def __prefetch_next_action(self, pool):
+        """Ask the LLM for the next instruction's action in the background,
+        so that it is ready by the time the current action has run. Returns a
+        future, or None if there is nothing to prefetch.
+
+        This is safe because the action only depends on the instruction, and
+        retrying the current instruction does not touch the queue."""
+        queue = self.instruction_compiler.instructions_queue
+        if not queue or not queue[0].strip():
+            return None
+        return pool.submit(
+            self.instruction_compiler.get_action_output, queue[0].strip()
+        )
+
     def __step_through_instructions(self):
         """In contrast to `__run_compiled_instructions`, this function will
         step through the instructions queue one at a time, calling the LLM for
         each instruction."""
-        ldict = {"env": self}
-        while self.instruction_compiler.instructions_queue:
-            # `step` will try the instruction for the first time.
-            step = self.instruction_compiler.step()
-
-            instruction = step["instruction"]
-            action = step["action_output"]
-            self.__print_instruction_and_action(instruction, action)
-
-            action = action.replace("```", "")
-            self._check_danger(action)
-
-            # Attempt evals.
-            attempts = 0
-            while attempts < 3:
-                attempts = attempts + 1
-                try:
-                    exec(action, globals(), ldict)
-                    break
-                except:
-                    stack_trace_result = self.__get_relevant_part_of_stack_trace()
-                    stack_trace = stack_trace_result["stack_trace"]
-                    line_num = stack_trace_result["line_num"]
-                    problem_instruction = "\nFailed on line: {line}\n".format(
-                        line=action.replace("\n\n", "\n").split("\n")[line_num - 1]
-                    )
-                    logging.info("\n\n" + stack_trace)
-                    logging.info(problem_instruction)
-
-                    if self.debug:
-                        pdb.set_trace()
-
-                    step = self.instruction_compiler.retry(problem_instruction + stack_trace)
-                    instruction = step["instruction"]
-                    action = step["action_output"].replace("```", "")
-                    logging.info("RETRYING...")
-                    self.__print_instruction_and_action(instruction, action)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            prefetched = None
+            while self.instruction_compiler.instructions_queue:
+                # `step` will try the instruction for the first time, reusing
+                # the action if it was prefetched.
+                action_info = prefetched.result() if prefetched else None
+                step = self.instruction_compiler.step(action_info)
+                prefetched = self.__prefetch_next_action(pool)
+
+                instruction = step["instruction"]
+                action = step["action_output"]
+                self.__print_instruction_and_action(instruction, action)
+
+                action = action.replace("```", "")
+                self._check_danger(action)
+
+                # Attempt evals.
+                attempts = 0
+                while attempts < 3:
+                    attempts = attempts + 1
+                    try:
+                        exec(self._compile_action(action), self._action_ns)
+                        break
+                    except:
+                        stack_trace_result = self.__get_relevant_part_of_stack_trace()
+                        stack_trace = stack_trace_result["stack_trace"]
+                        line_num = stack_trace_result["line_num"]
+                        problem_instruction = "\nFailed on line: {line}\n".format(
+                            line=action.split("\n")[line_num - 1]
+                        )
+                        logging.info("\n\n" + stack_trace)
+                        logging.info(problem_instruction)
+
+                        if self.debug:
+                            pdb.set_trace()
+
+                        step = self.instruction_compiler.retry(problem_instruction + stack_trace)
+                        instruction = step["instruction"]
+                        action = step["action_output"].replace("```", "")
+                        logging.info("RETRYING...")
+                        self.__print_instruction_and_action(instruction, action)
 
         if self.instruction_output_file:
             self.instruction_compiler.save_compiled_instructions(
                 self.instruction_output_file
             )
-        
-        exec("env.driver.quit()", globals(), ldict)
+
+        exec(self._QUIT_CODE, self._action_ns)
 
     """Functions meant for the client to call."""
 
@@ -230,10 +524,15 @@ class GPTSeleniumAgent:
     def get(self, url):
         if not url.startswith("http"):
             url = "http://" + url
+        self._dom_cache.clear()
         self.driver.get(url)
-        time.sleep(3)
+        WebDriverWait(self.driver, 10).until(
+            lambda d: d.execute_script("return document.readyState") == "complete"
+        )
+        self.driver.execute_script(INSTALL_MUTATION_COUNTER_JS)
 
     def scroll(self, direction):
+        self._dom_cache.clear()
         if direction == "up":
             # Do the python equivalent of the following JavaScript:
             # "(document.scrollingElement || document.body).scrollTop = (document.scrollingElement || document.body).scrollTop - window.innerHeight;"
@@ -245,14 +544,13 @@ class GPTSeleniumAgent:
 
     def find_nearest_textbox(self, element):
         try:
-            textbox = self.driver.find_element(
-                locate_with(By.XPATH, "//div[@role = 'textbox']").near(element)
+            return self.driver.find_element(
+                locate_with(By.XPATH, "//div[@role = 'textbox'] | //input").near(
+                    element
+                )
             )
-        except:
-            textbox = self.driver.find_element(
-                locate_with(By.TAG_NAME, "input").near(element)
-            )
-        return textbox
+        except NoSuchElementException:
+            return None
 
     def find_nearest_text(self, element):
         try:
@@ -264,38 +562,54 @@ class GPTSeleniumAgent:
         return textbox.text
 
     def find_nearest(self, e, xpath):
-        try:
-            return self.driver.find_element(locate_with(By.XPATH, xpath).near(e))
-        except:
-            return self.driver.find_element(locate_with(By.XPATH, xpath).below(e))
+        # `near` and `below` can't be combined into one query, but
+        # `find_elements` at least avoids raising on the common path.
+        nearby = self.driver.find_elements(locate_with(By.XPATH, xpath).near(e))
+        if nearby:
+            return nearby[0]
+        return self.driver.find_element(locate_with(By.XPATH, xpath).below(e))
 
     def send_keys(self, keys):
-        ActionChains(self.driver).pause(1).send_keys(keys).pause(1).perform()
+        self._dom_cache.clear()
+        ActionChains(self.driver).send_keys(keys).perform()
 
     def click(self, element):
-        ActionChains(self.driver).pause(1).move_to_element(element).pause(1).click(
-            element
-        ).perform()
+        self._dom_cache.clear()
+        WebDriverWait(self.driver, 5).until(EC.element_to_be_clickable(element))
+        ActionChains(self.driver).move_to_element(element).click(element).perform()
 
     def get_text_from_page(self, entire_page=False):
         """Returns the text from the page."""
-        # First, we get the HTML of the page and use html2text to convert it
-        # to text.
+        # First, we get the HTML of the page and parse it with lxml. It is
+        # parsed as UTF-8 bytes, since lxml rejects strings that carry an
+        # encoding declaration, e.g., XHTML pages.
+        tree = lxml_html.fromstring(
+            self.driver.page_source.encode("utf-8"),
+            parser=lxml_html.HTMLParser(encoding="utf-8"),
+        )
         if entire_page:
-            html = self.driver.page_source
-            text = html2text.html2text(html)
+            # Drop scripts and styles, whose contents are not page text. Then
+            # put each text node on its own line, so that adjacent blocks are
+            # not glued together.
+            for element in tree.xpath("//script|//style"):
+                element.drop_tree()
+            text = "\n".join(t.strip() for t in tree.itertext() if t.strip())
         else:
             # Only the paragraph elements.
-            soup = BeautifulSoup(self.driver.page_source, "lxml")
-            text = "\n".join([p.text for p in soup.find_all("p")])
-
-        # Check for iframes too.
-        iframes = self.driver.find_elements(by=By.TAG_NAME, value="iframe")
-        for iframe in iframes:
-            self.driver.switch_to.frame(iframe)
-            soup = BeautifulSoup(self.driver.page_source, "lxml")
-            text = text + "\n" + "\n".join([p.text for p in soup.find_all("p")])
-            self.driver.switch_to.default_content()
+            text = "\n".join([p.text_content() for p in tree.xpath("//p")])
+
+        # Check for iframes too. Cross-origin frames have to be switched into
+        # to be read.
+        iframe_texts = self.driver.execute_script(IFRAME_PARAGRAPHS_JS)
+        if None in iframe_texts:
+            iframes = self.driver.find_elements(by=By.TAG_NAME, value="iframe")
+            for i, iframe_text in enumerate(iframe_texts):
+                if iframe_text is None:
+                    self.driver.switch_to.frame(iframes[i])
+                    iframe_texts[i] = self.driver.execute_script(PARAGRAPHS_JS)
+                    self.driver.switch_to.default_content()
+        if iframe_texts:
+            text = text + "\n" + "\n".join(iframe_texts)
 
         return text
 
@@ -303,62 +617,76 @@ class GPTSeleniumAgent:
         """Retrieves information using using GPT-Index embeddings from a page."""
         text = self.get_text_from_page(entire_page=entire_page)
 
-        # Tokenize by sentence, and then load each set of three sentences as
+        # Tokenize by sentence, and then load each set of five sentences as
         # a doc.
-        sentences = sent_tokenize(text)
-        docs = []
-        for i in range(0, len(sentences), 5):
-            doc = " ".join(sentences[i : i + 5])
-            docs.append(Document(doc))
+        if self._sentence_tokenizer is None:
+            self._sentence_tokenizer = nltk.data.load(
+                "tokenizers/punkt/english.pickle"
+            )
+        sentences = self._sentence_tokenizer.tokenize(text)
+        chunks = [
+            " ".join(sentences[i : i + 5]) for i in range(0, len(sentences), 5)
+        ]
 
         # Then we use GPT Index to summarize the text.
-        logging.info("Found {num_docs} documents for indexing.".format(num_docs=len(docs)))
-        index = GPTSimpleVectorIndex(docs)
+        logging.info("Found {num_docs} documents for indexing.".format(num_docs=len(chunks)))
+        index = self._build_index(chunks, persist=True)
         print(text[:150])
         logging.info("Retrieving information with prompt: \"{prompt}\"".format(prompt=prompt))
         resp = index.query(prompt, similarity_top_k=3)
         return resp.response.strip()
 
-    def get_llm_response(self, prompt, temperature=0.7, model="text-davinci-003"):
-        try:
-            response = openai.Completion.create(
-                model=model,
-                prompt=prompt,
-                temperature=temperature,
-                max_tokens=512,
-                top_p=1,
-                frequency_penalty=0,
-                presence_penalty=0,
-                best_of=3,
-            )
+    def get_llm_response(
+        self, prompt, temperature=0.7, model="gpt-3.5-turbo-instruct", best_of=1
+    ):
+        """Get a completion for the prompt. Pass `best_of` > 1 to have the
+        API generate several completions and return the best one, at a
+        proportionally higher token cost."""
+        key = (model, round(temperature, 2), prompt)
+        if key in self._llm_cache:
+            return self._llm_cache[key]
+
+        for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+            try:
+                response = openai.Completion.create(
+                    model=model,
+                    prompt=prompt,
+                    temperature=temperature,
+                    max_tokens=512,
+                    top_p=1,
+                    frequency_penalty=0,
+                    presence_penalty=0,
+                    best_of=best_of,
+                )
+                break
+            except openai.error.RateLimitError as exc:
+                if attempt == MAX_RATE_LIMIT_RETRIES:
+                    raise
+                delay = 2**attempt
+                logging.info(
+                    "Rate limit error: {exc}. Sleeping for {delay} seconds.".format(
+                        exc=str(exc), delay=delay
+                    )
+                )
+                time.sleep(delay)
 
-            # Next, we extract the response that was generated by the API.
-            text = response["choices"][0]["text"]
-            # Finally, we return the response.
-            return text
-        except openai.error.RateLimitError as exc:
-            logging.info(
-                "Rate limit error: {exc}. Sleeping for 10 seconds.".format(exc=str(exc))
-            )
-            time.sleep(5)
-            return self.get_llm_response(prompt, model)
+        # Next, we extract the response that was generated by the API.
+        text = response["choices"][0]["text"]
+
+        # Finally, we cache and return the response.
+        self._cache_llm_response(key, text)
+        return text
 
     def ask_llm_to_find_element(self, element_description):
         """Clean the HTML from self.driver, ask GPT-Index to find the element,
         and return Selenium code to access it. Return a WebElement."""
-        soup = self._clean_html()
-        # Get all of the elements, and for each element, if there are
-        # children, then remove them.
-        elements = soup.find_all()
-        [ele.clear() if ele.contents else ele for ele in elements if ele.contents]
-        # Then remove any elements that do not have attributes, e.g., <p></p>.
-        elements = [ele for ele in elements if ele.attrs]
-
-        # Create a list of documents of each element prettified.
-        docs = [Document(element.prettify()) for element in elements]
-
-        # Set up the index and query it.
-        index = GPTSimpleVectorIndex(docs)
+        elements = self._select_candidate_elements(self._get_candidate_elements())
+
+        # Set up the index and query it. The DOM changes after almost every
+        # action, so the index is only kept in memory for this page state.
+        if "index" not in self._dom_cache:
+            self._dom_cache["index"] = self._build_index(elements)
+        index = self._dom_cache["index"]
         query = "Find element that matches description: {element_description}. If no element matches the description, then return {no_resp_token}.".format(
             element_description=element_description, no_resp_token=NO_RESPONSE_TOKEN
         )
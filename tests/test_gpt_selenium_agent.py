@@ -0,0 +1,109 @@
+import pytest
+
+from browserpilot.agents.gpt_selenium_agent import GPTSeleniumAgent
+
+
+@pytest.mark.parametrize(
+    "code_str",
+    [
+        "import os",
+        "from shutil import rmtree",
+        "os.system('ls')",
+        "__import__('os')",
+        "exec(\"import shutil; shutil.rmtree('/')\")",
+        "eval('__import__(\"os\")')",
+        "getattr(__builtins__, '__imp' + 'ort__')('os')",
+        "f = compile('import os', '<x>', 'exec')",
+        "env.click.__globals__['os']",
+        "().__class__.__base__.__subclasses__()",
+        "globals()['__builtins__']['__import__']('os').system('id')",
+        "vars()['__builtins__']['exec']('import os')",
+        "env._action_ns['__builtins__']['__import__']('os')",
+    ],
+)
+def test_dangerous_code_is_flagged(code_str):
+    assert GPTSeleniumAgent._is_potentially_dangerous(code_str)
+
+
+@pytest.mark.parametrize(
+    "code_str",
+    [
+        'env.get("https://www.google.com")',
+        'boxes = env.driver.find_elements(by="xpath", value="//input")\n'
+        "visible = [box for box in boxes if box.is_displayed()]\n"
+        "env.click(visible[0])",
+        'env.send_keys("shutil and os are just words here" + Keys.ENTER)',
+    ],
+)
+def test_safe_code_is_not_flagged(code_str):
+    assert not GPTSeleniumAgent._is_potentially_dangerous(code_str)
+
+
+def test_candidate_elements_are_deduped():
+    elements = ['<li class="item"/>', '<a href="/a"/>', '<li class="item"/>']
+    selected = GPTSeleniumAgent._select_candidate_elements(elements)
+    assert selected == ['<li class="item"/>', '<a href="/a"/>']
+
+
+def test_candidate_elements_keep_rare_tags_when_truncated(monkeypatch):
+    monkeypatch.setattr(
+        "browserpilot.agents.gpt_selenium_agent.MAX_CANDIDATE_ELEMENTS", 3
+    )
+    elements = ['<td id="{i}"/>'.format(i=i) for i in range(5)]
+    elements += ['<td id="5" class="x"/>', '<button id="login"/>']
+    selected = GPTSeleniumAgent._select_candidate_elements(elements)
+    # The only button and the cell with the most attributes survive, in page
+    # order.
+    assert selected == ['<td id="0"/>', '<td id="5" class="x"/>', '<button id="login"/>']
+
+
+def make_agent(cache_dir):
+    """Set up just the LLM response cache, without starting a browser."""
+    agent = object.__new__(GPTSeleniumAgent)
+    agent.cache_dir = cache_dir
+    agent._llm_cache = {}
+    agent._load_llm_cache()
+    return agent
+
+
+def test_llm_responses_are_cached_across_runs(tmp_path, monkeypatch):
+    prompts = []
+
+    def create(prompt, **kwargs):
+        prompts.append(prompt)
+        return {"choices": [{"text": "answer"}]}
+
+    monkeypatch.setattr("openai.Completion.create", create)
+    cache_dir = tmp_path / "cache"
+    agent = make_agent(str(cache_dir))
+    assert not cache_dir.exists()
+
+    assert agent.get_llm_response("question") == "answer"
+    assert agent.get_llm_response("question") == "answer"
+    assert make_agent(str(cache_dir)).get_llm_response("question") == "answer"
+    assert prompts == ["question"]
+
+    # Different temperatures are cached separately.
+    agent.get_llm_response("question", temperature=0)
+    assert prompts == ["question", "question"]
+
+
+def test_llm_cache_keeps_most_recent_responses(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        "browserpilot.agents.gpt_selenium_agent.MAX_CACHED_LLM_RESPONSES", 2
+    )
+    agent = make_agent(str(tmp_path))
+    for prompt in ["a", "b", "c"]:
+        agent._cache_llm_response(("model", 0, prompt), prompt.upper())
+    assert make_agent(str(tmp_path))._llm_cache == {
+        ("model", 0, "b"): "B",
+        ("model", 0, "c"): "C",
+    }
+
+
+def test_llm_cache_without_cache_dir_stays_in_memory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    agent = make_agent(None)
+    agent._cache_llm_response(("model", 0, "a"), "A")
+    assert agent._llm_cache == {("model", 0, "a"): "A"}
+    assert list(tmp_path.iterdir()) == []